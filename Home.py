@@ -1,9 +1,28 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import openpyxl
+from python_calamine import CalamineWorkbook
 from datetime import datetime
 import re
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
 from io import BytesIO
 
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; expand_punch_records falls back to pandas
+    njit = None
+
+# Precompiled patterns for punch extraction and column reordering
+_PUNCH_RE = re.compile(r'(?P<t>\d{1,2}:\d{2}:\d{2})\((?P<s>in|out)\)', re.IGNORECASE)
+_COL_RE = re.compile(r"(Time In|Time Out|Stay Duration) (\d+)$")
+_PUNCH_KIND_ORDER = {"Time In": 0, "Time Out": 1, "Stay Duration": 2}
+
 # Session state initialization
 if "uploaded_files" not in st.session_state:
     st.session_state.uploaded_files = []
@@ -41,14 +60,300 @@ if st.session_state.uploaded_files:
             new_params["rerun"] = ["1"] if current_params.get("rerun") != ["1"] else ["0"]
             st.query_params = new_params
 
-# Function to find header row containing 'Punch Records'
-def find_header_row(df):
-    for i in range(min(10, len(df))):  # Check first 10 rows for header row
-        row_values = df.iloc[i].astype(str).str.lower()
-        if any('punch records' in val for val in row_values):
-            return i
+# Function to find header row containing 'Punch Records' (rows are sequences of cell values)
+def find_header_row(rows):
+    for i, row in zip(range(10), rows):  # Check first 10 rows for header row
+        for val in row:
+            if isinstance(val, str) and 'punch records' in val.lower():
+                return i
     return None
 
+# Format whole minutes (integer array) as HH:MM with NumPy string ops, blank where not valid
+def format_stay_duration(delta_min, valid):
+    if delta_min.size == 0:  # np.char ops fail on empty arrays
+        return np.full(delta_min.shape, "")
+    hours = np.char.zfill((delta_min // 60).astype(str), 2)
+    minutes = np.char.zfill((delta_min % 60).astype(str), 2)
+    return np.where(valid, np.char.add(np.char.add(hours, ":"), minutes), "")
+
+# Slow path when Numba is unavailable: pandas regex extraction, then durations per pair
+def expand_punches_pandas(records):
+    matches = records.str.extractall(_PUNCH_RE)
+    matches['s'] = matches['s'].str.lower()
+    matches['n'] = matches.groupby([matches.index.get_level_values(0), 's']).cumcount() + 1
+
+    # Pivot the long-form matches into Time In/Out columns
+    expanded_df = matches.set_index(['s', 'n'], append=True)['t'].droplevel('match').unstack(['s', 'n'])
+    expanded_df.columns = [f"Time {'In' if status == 'in' else 'Out'} {n}" for status, n in expanded_df.columns]
+    expanded_df = expanded_df.reindex(records.index)
+
+    # Calculate Stay Duration for each pair, one vectorized pass per pair index
+    pair_count = 0
+    while f"Time In {pair_count + 1}" in expanded_df.columns and f"Time Out {pair_count + 1}" in expanded_df.columns:
+        pair_count += 1
+
+    for i in range(1, pair_count + 1):
+        t_in = pd.to_datetime(expanded_df[f"Time In {i}"], format="%H:%M:%S", errors="coerce")
+        t_out = pd.to_datetime(expanded_df[f"Time Out {i}"], format="%H:%M:%S", errors="coerce")
+        delta_min = (t_out - t_in).dt.total_seconds() // 60
+        expanded_df[f"Stay Duration {i}"] = format_stay_duration(
+            delta_min.fillna(0).to_numpy(np.int64), delta_min.notna().to_numpy()
+        )
+
+    return expanded_df
+
+def _is_digit(c):
+    return 48 <= c <= 57
+
+# Match one "H:MM:SS(in)" / "HH:MM:SS(out)" token at pos, case-insensitive, same rules as the regex.
+# Returns (match length, time length, kind: 1=in 2=out 0=no match, seconds of day or -1 if not a valid time)
+def _match_punch(buf, pos, end):
+    for hour_len in (2, 1):
+        p = pos + hour_len  # first ':'
+        if p + 6 > end:
+            continue
+        if not (_is_digit(buf[pos]) and (hour_len == 1 or _is_digit(buf[pos + 1]))):
+            continue
+        if not (buf[p] == 58 and _is_digit(buf[p + 1]) and _is_digit(buf[p + 2])
+                and buf[p + 3] == 58 and _is_digit(buf[p + 4]) and _is_digit(buf[p + 5])):
+            continue
+
+        # "(in)" or "(out)"; OR-ing 32 lowercases ASCII letters
+        q = p + 6
+        if q + 4 <= end and buf[q] == 40 and (buf[q + 1] | 32) == 105 and (buf[q + 2] | 32) == 110 and buf[q + 3] == 41:
+            kind, match_len = 1, q + 4 - pos
+        elif (q + 5 <= end and buf[q] == 40 and (buf[q + 1] | 32) == 111 and (buf[q + 2] | 32) == 117
+              and (buf[q + 3] | 32) == 116 and buf[q + 4] == 41):
+            kind, match_len = 2, q + 5 - pos
+        else:
+            continue
+
+        hours = buf[pos] - 48 if hour_len == 1 else (buf[pos] - 48) * 10 + buf[pos + 1] - 48
+        minutes = (buf[p + 1] - 48) * 10 + buf[p + 2] - 48
+        seconds = (buf[p + 4] - 48) * 10 + buf[p + 5] - 48
+        if hours < 24 and minutes < 60 and seconds < 60:
+            return match_len, hour_len + 6, kind, hours * 3600 + minutes * 60 + seconds
+        return match_len, hour_len + 6, kind, -1
+    return 0, 0, 0, -1
+
+# Single pass over the utf-8 bytes of every record (row r is buf[offsets[r]:offsets[r + 1]]).
+# Returns (n_rows, max_pairs) arrays of time positions, lengths and seconds for In and Out punches
+# (-1 where missing), plus stay minutes and a validity mask for each In/Out pair.
+def parse_punches(buf, offsets):
+    n_rows = offsets.shape[0] - 1
+
+    # Count punches first so the outputs can be preallocated
+    max_in, max_out = 0, 0
+    for r in range(n_rows):
+        n_in, n_out = 0, 0
+        pos, end = offsets[r], offsets[r + 1]
+        while pos < end:
+            match_len, time_len, kind, secs = _match_punch(buf, pos, end)
+            if kind == 0:
+                pos += 1
+                continue
+            if kind == 1:
+                n_in += 1
+            else:
+                n_out += 1
+            pos += match_len
+        max_in = max(max_in, n_in)
+        max_out = max(max_out, n_out)
+
+    in_pos = np.full((n_rows, max_in), -1, np.int64)
+    in_len = np.zeros((n_rows, max_in), np.int64)
+    in_sec = np.full((n_rows, max_in), -1, np.int32)
+    out_pos = np.full((n_rows, max_out), -1, np.int64)
+    out_len = np.zeros((n_rows, max_out), np.int64)
+    out_sec = np.full((n_rows, max_out), -1, np.int32)
+    pairs = min(max_in, max_out)
+    stay_min = np.zeros((n_rows, pairs), np.int32)
+    stay_ok = np.zeros((n_rows, pairs), np.bool_)
+
+    for r in range(n_rows):
+        n_in, n_out = 0, 0
+        pos, end = offsets[r], offsets[r + 1]
+        while pos < end:
+            match_len, time_len, kind, secs = _match_punch(buf, pos, end)
+            if kind == 0:
+                pos += 1
+                continue
+            if kind == 1:
+                in_pos[r, n_in], in_len[r, n_in], in_sec[r, n_in] = pos, time_len, secs
+                n_in += 1
+            else:
+                out_pos[r, n_out], out_len[r, n_out], out_sec[r, n_out] = pos, time_len, secs
+                n_out += 1
+            pos += match_len
+
+        for i in range(pairs):
+            if in_sec[r, i] >= 0 and out_sec[r, i] >= 0:
+                stay_min[r, i] = (out_sec[r, i] - in_sec[r, i]) // 60
+                stay_ok[r, i] = True
+
+    return in_pos, in_len, in_sec, out_pos, out_len, out_sec, stay_min, stay_ok
+
+if njit is not None:
+    _is_digit = njit(cache=True)(_is_digit)
+    _match_punch = njit(cache=True)(_match_punch)
+    parse_punches = njit(cache=True)(parse_punches)
+
+# Cut the original time strings out of the padded record buffer, NaN where a punch is missing
+def _punch_times(buf, pos, length):
+    width = np.arange(8)
+    chars = buf[pos[..., None] + width]
+    chars[width >= length[..., None]] = 0
+    times = chars.view("S8")[..., 0].astype(str).astype(object)
+    times[pos < 0] = np.nan
+    return times
+
+# Fused Numba pass: Time In/Out and Stay Duration columns straight from the record bytes
+def expand_punches_numba(records):
+    arrow_records = pa.array(records, type=pa.string(), from_pandas=True)
+    _, offsets_buf, data_buf = arrow_records.buffers()
+    offsets = np.frombuffer(offsets_buf, np.int32)[arrow_records.offset:arrow_records.offset + len(arrow_records) + 1]
+    data = np.frombuffer(data_buf, np.uint8) if data_buf is not None else np.empty(0, np.uint8)
+    buf = np.concatenate([data, np.zeros(8, np.uint8)])  # padding keeps 8-byte gathers in bounds
+
+    in_pos, in_len, in_sec, out_pos, out_len, out_sec, stay_min, stay_ok = parse_punches(buf, offsets)
+    in_times = _punch_times(buf, in_pos, in_len)
+    out_times = _punch_times(buf, out_pos, out_len)
+
+    columns = {}
+    for i in range(in_times.shape[1]):
+        columns[f"Time In {i + 1}"] = in_times[:, i]
+    for i in range(out_times.shape[1]):
+        columns[f"Time Out {i + 1}"] = out_times[:, i]
+    stays = format_stay_duration(stay_min, stay_ok)
+    for i in range(stays.shape[1]):
+        columns[f"Stay Duration {i + 1}"] = stays[:, i]
+    return columns
+
+# Split the Punch Records column into Time In/Out and Stay Duration columns.
+# Returns {column name: values} aligned with records so callers can assign columns in place.
+def expand_punch_records(records):
+    # Parse each distinct record once; a missing record has code -1, which picks the trailing None
+    codes, uniques = pd.factorize(records)
+    unique_records = pd.Series([*uniques, None], dtype=object)
+
+    if njit is None:
+        unique_columns = expand_punches_pandas(unique_records)
+    else:
+        unique_columns = expand_punches_numba(unique_records)
+    return {col: np.asarray(values)[codes] for col, values in unique_columns.items()}
+
+# Write the uploaded bytes to a temporary file and yield its path, so the readers
+# work from disk instead of making further in-memory copies; removed afterwards
+@contextmanager
+def spilled_upload(file_bytes, suffix):
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        tmp.write(file_bytes)
+    try:
+        yield tmp.name
+    finally:
+        os.remove(tmp.name)
+
+# Read a CSV/Excel file from path into a DataFrame named by its 'Punch Records' header row
+def read_punch_table(path, filename):
+    if filename.lower().endswith(".csv"):
+        # Multithreaded Arrow CSV reader; try utf-8, fallback to latin1
+        convert_options = pacsv.ConvertOptions(strings_can_be_null=True)
+        table = pacsv.read_csv(
+            path,
+            read_options=pacsv.ReadOptions(autogenerate_column_names=True, encoding="utf-8"),
+            convert_options=convert_options,
+        )
+        # Arrow infers columns with invalid utf-8 as binary instead of raising
+        if any(pa.types.is_binary(field.type) for field in table.schema):
+            table = pacsv.read_csv(
+                path,
+                read_options=pacsv.ReadOptions(autogenerate_column_names=True, encoding="latin1"),
+                convert_options=convert_options,
+            )
+
+        # Find header row dynamically while the data is still columnar Arrow,
+        # then convert only the rows below it to pandas
+        header_row_idx = find_header_row(table.slice(0, 10).to_pandas().itertuples(index=False))
+        if header_row_idx is None:
+            raise ValueError("No header row containing 'Punch Records' found.")
+        header = table.slice(header_row_idx, 1).to_pylist()[0].values()
+        df_clean = table.slice(header_row_idx + 1).to_pandas()
+        df_clean.columns = pd.Index(list(header), dtype=object)
+
+    else:
+        # Peek at the first rows only to find the header row;
+        # calamine reads both .xls and .xlsx, fall back to openpyxl if it fails
+        try:
+            workbook = CalamineWorkbook.from_path(path)
+            head_rows = workbook.get_sheet_by_index(0).to_python(skip_empty_area=False, nrows=10)
+            workbook.close()
+            engine = "calamine"
+        except Exception:
+            workbook = openpyxl.load_workbook(path, read_only=True)
+            head_rows = list(workbook.active.iter_rows(max_row=10, values_only=True))
+            workbook.close()
+            engine = "openpyxl"
+
+        header_row_idx = find_header_row(head_rows)
+        if header_row_idx is None:
+            raise ValueError("No header row containing 'Punch Records' found.")
+
+        # Let read_excel skip the prefix and name the columns in one pass;
+        # dtype=object keeps cell values as read (e.g. integer IDs stay integers)
+        df_clean = pd.read_excel(path, header=header_row_idx, engine=engine, dtype=object)
+
+    return df_clean
+
+# Full cleaning pipeline for one uploaded file, independent of the page widgets.
+# Cached on the file contents so reruns (tab switches, button clicks) skip it entirely.
+@st.cache_data(show_spinner=False)
+def clean_punch_dataframe(file_bytes, filename):
+    # Robust file reading for CSV and Excel formats, from a temporary copy on disk
+    with spilled_upload(file_bytes, os.path.splitext(filename)[1]) as path:
+        df_clean = read_punch_table(path, filename)
+
+    df_clean.columns = df_clean.columns.str.strip()  # strip spaces
+
+    # Drop irrelevant columns
+    if 'S.No' in df_clean.columns:
+        df_clean = df_clean.drop(columns=['S.No'])
+
+    # Drop columns without a header (read_excel names those "Unnamed: n")
+    df_clean = df_clean.loc[:, ~(df_clean.columns.isna() | df_clean.columns.str.startswith("Unnamed:", na=True))]
+
+    # Check for Punch Records column again after cleaning
+    if 'Punch Records' not in df_clean.columns:
+        raise ValueError("'Punch Records' column not found. Available columns: " +
+                         ", ".join(map(str, df_clean.columns)))
+
+    # Extract In/Out times and Stay Durations in a single pass
+    # Columns are assigned in place rather than concatenated to avoid copying the frame
+    punch_columns = expand_punch_records(df_clean.pop('Punch Records'))
+    for col, values in punch_columns.items():
+        df_clean[col] = values
+
+    # Reorder columns: fixed columns keep their order, then In/Out/Duration per pair
+    fixed_order = {col: n for n, col in enumerate(df_clean.columns)}
+
+    def column_sort_key(col):
+        m = _COL_RE.match(col)
+        if m:
+            return (1, int(m.group(2)), _PUNCH_KIND_ORDER[m.group(1)])
+        return (0, fixed_order[col], 0)
+
+    return df_clean[sorted(df_clean.columns, key=column_sort_key)]
+
+# Serialize the cleaned data to xlsx once per uploaded file instead of on every rerun.
+# The leading underscore keeps Streamlit from hashing the DataFrame; file_key is the cache key.
+# Text cells are written as-is: xlsxwriter's per-string number/URL/formula sniffing is switched off.
+@st.cache_data(show_spinner=False)
+def build_xlsx_bytes(_df, file_key):
+    output = BytesIO()
+    options = {'strings_to_numbers': False, 'strings_to_urls': False, 'strings_to_formulas': False}
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': options}) as writer:
+        _df.to_excel(writer, index=False, sheet_name='Cleaned Data')
+    return output.getvalue()
+
 # Main processing if files are available
 if st.session_state.uploaded_files:
     tabs = st.tabs([file.name for file in st.session_state.uploaded_files])
@@ -58,123 +363,7 @@ if st.session_state.uploaded_files:
             st.markdown(f"### 📄 `{file.name}`")
 
             try:
-                # Robust file reading for CSV and Excel formats
-                filename = file.name.lower()
-
-                if filename.endswith(".csv"):
-                    # Try utf-8, fallback to latin1
-                    try:
-                        df_raw = pd.read_csv(file, header=None, encoding="utf-8")
-                    except UnicodeDecodeError:
-                        df_raw = pd.read_csv(file, header=None, encoding="latin1")
-
-                elif filename.endswith(".xls"):
-                    # Try 'xlrd' engine (supports old .xls)
-                    try:
-                        df_raw = pd.read_excel(file, header=None, engine="xlrd")
-                    except Exception:
-                        # fallback to openpyxl
-                        df_raw = pd.read_excel(file, header=None, engine="openpyxl")
-
-                else:
-                    # For .xlsx and others, try openpyxl
-                    try:
-                        df_raw = pd.read_excel(file, header=None, engine="openpyxl")
-                    except Exception:
-                        # fallback to default engine
-                        df_raw = pd.read_excel(file, header=None)
-
-                # Find header row dynamically
-                header_row_idx = find_header_row(df_raw)
-                if header_row_idx is None:
-                    raise ValueError("No header row containing 'Punch Records' found.")
-
-                # Set header and clean data
-                df_clean = df_raw.iloc[header_row_idx:].reset_index(drop=True)
-                df_clean.columns = df_clean.iloc[0].str.strip()  # strip spaces
-                df_clean = df_clean[1:].reset_index(drop=True)
-
-                # Drop irrelevant columns
-                if 'S.No' in df_clean.columns:
-                    df_clean = df_clean.drop(columns=['S.No'])
-
-                df_clean = df_clean.loc[:, ~df_clean.columns.isna()]
-
-                # Check for Punch Records column again after cleaning
-                if 'Punch Records' not in df_clean.columns:
-                    st.warning("⚠️ 'Punch Records' column not found. Available columns: " +
-                               ", ".join(map(str, df_clean.columns)))
-                    raise ValueError("Missing 'Punch Records' column")
-
-                # Extract multiple In/Out times dynamically
-                def extract_multiple_in_out(punch_record):
-                    if pd.isna(punch_record):
-                        return {}
-
-                    entries = re.findall(r'(\d{1,2}:\d{2}:\d{2})\((in|out)\)', punch_record.lower())
-
-                    punch_dict = {}
-                    in_count, out_count = 1, 1
-                    for time_str, status in entries:
-                        if status == "in":
-                            punch_dict[f"Time In {in_count}"] = time_str
-                            in_count += 1
-                        elif status == "out":
-                            punch_dict[f"Time Out {out_count}"] = time_str
-                            out_count += 1
-
-                    return punch_dict
-
-                # Apply to Punch Records and expand
-                expanded_df = df_clean['Punch Records'].apply(extract_multiple_in_out).apply(pd.Series)
-                df_clean = pd.concat([df_clean.drop(columns=['Punch Records']), expanded_df], axis=1)
-
-                # Calculate Stay Duration for each pair
-                def calculate_stay_durations(row):
-                    result = {}
-                    i = 1
-                    while f"Time In {i}" in row and f"Time Out {i}" in row:
-                        time_in = row.get(f"Time In {i}")
-                        time_out = row.get(f"Time Out {i}")
-                        try:
-                            if pd.notna(time_in) and pd.notna(time_out):
-                                t_in = pd.to_datetime(time_in, format="%H:%M:%S")
-                                t_out = pd.to_datetime(time_out, format="%H:%M:%S")
-                                diff = t_out - t_in
-                                total_minutes = diff.total_seconds() / 60
-                                hours = int(total_minutes // 60)
-                                minutes = int(total_minutes % 60)
-                                result[f"Stay Duration {i}"] = f"{hours:02}:{minutes:02}"
-                            else:
-                                result[f"Stay Duration {i}"] = ""
-                        except:
-                            result[f"Stay Duration {i}"] = ""
-                        i += 1
-                    return pd.Series(result)
-
-                # Calculate and merge Stay Durations
-                stay_durations_df = df_clean.apply(calculate_stay_durations, axis=1)
-                df_clean = pd.concat([df_clean, stay_durations_df], axis=1)
-
-                # Reorder columns
-                fixed_cols = [col for col in df_clean.columns if not re.match(r'Time (In|Out) \d+|Stay Duration \d+', col)]
-                punches = {}
-                for col in df_clean.columns:
-                    m = re.match(r"(Time In|Time Out|Stay Duration) (\d+)", col)
-                    if m:
-                        group = int(m.group(2))
-                        punches.setdefault(group, {})[m.group(1)] = col
-
-                reordered_punch_cols = []
-                for i in sorted(punches.keys()):
-                    reordered_punch_cols += [
-                        punches[i].get("Time In", f"Time In {i}"),
-                        punches[i].get("Time Out", f"Time Out {i}"),
-                        punches[i].get("Stay Duration", f"Stay Duration {i}")
-                    ]
-
-                final_cols = fixed_cols + reordered_punch_cols
-                df_clean = df_clean[[col for col in final_cols if col in df_clean.columns]]
+                df_clean = clean_punch_dataframe(file.getvalue(), file.name)
 
                 # Show cleaned data
                 st.dataframe(df_clean, use_container_width=True)
@@ -183,14 +372,11 @@ if st.session_state.uploaded_files:
                 today = datetime.now().strftime("%d-%m-%Y")
                 cleaned_name = f"Cleaned_{today}.xlsx"
 
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df_clean.to_excel(writer, index=False, sheet_name='Cleaned Data')
-                output.seek(0)
+                file_key = f"{file.name}-{hashlib.md5(file.getvalue()).hexdigest()}"
 
                 st.download_button(
                     label="💾 Save Cleaned File",
-                    data=output,
+                    data=build_xlsx_bytes(df_clean, file_key),
                     file_name=cleaned_name,
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     key=f"save_{idx}"